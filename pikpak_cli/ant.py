@@ -1,11 +1,47 @@
+import asyncio
+import concurrent.futures
+import contextlib
 import os
 import typing
 
-import aiofiles
+import httpx
 from ant_nest import ant, pipelines
 from tqdm import tqdm
 
 import settings
+from pikpak_cli.utils import gather, json_dumps, json_loads
+
+
+def load_json(res: httpx.Response) -> typing.Any:
+    return json_loads(res.content)
+
+
+def progress_bar(initial: int, total: int) -> tqdm:
+    # redraw at most 4 times a second, no matter how many chunks arrive
+    return tqdm(
+        initial=initial,
+        total=total,
+        unit_scale=True,
+        unit_divisor=1024,
+        unit="B",
+        ascii=" \\/>",
+        mininterval=0.25,
+        smoothing=0.3,
+    )
+
+
+def parts_generator(
+    size: int, start: int = 0, part_size: int = 10 * 1024 * 1024
+) -> typing.Iterator[typing.Tuple[int, int]]:
+    """Yield (start, end) byte ranges, both inclusive"""
+    while start < size:
+        end = min(start + part_size, size)
+        yield start, end - 1
+        start = end
+
+
+class RangeNotSupported(Exception):
+    pass
 
 
 class ErrorPipeline(pipelines.Pipeline):
@@ -19,15 +55,15 @@ class ErrorPipeline(pipelines.Pipeline):
 class AuthPipeline(pipelines.Pipeline):
     def __init__(self):
         super().__init__()
-        self.token = {}
+        self.set_token({})
+
+    def set_token(self, token: typing.Dict):
+        self.token = token
+        self.authorization = f"{token.get('token_type')} {token.get('access_token')}"
 
     async def process(self, obj: pipelines.Request) -> pipelines.Request:
         if "auth" not in obj.url.path:
-            obj.headers.update(
-                {
-                    "Authorization": f"{self.token.get('token_type')} {self.token.get('access_token')}"
-                }
-            )
+            obj.headers["Authorization"] = self.authorization
 
         return obj
 
@@ -37,6 +73,13 @@ class Pikpak(ant.Ant):
     request_pipelines = [auth_pipeline, pipelines.RequestRandomUserAgentPipeline()]
     response_pipelines = [ErrorPipeline()]
 
+    def __init__(self):
+        super().__init__()
+        # download links are signed CDN urls, stream them without the pipelines
+        self.download_client = httpx.AsyncClient(**settings.DOWNLOAD_HTTPX_CONFIG)
+        # one writer thread serializes the file writes of all downloads
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
     async def login(self, account: str = "", password: str = ""):
         res = await self.request(
             "https://user.mypikpak.com/v1/auth/signin",
@@ -49,8 +92,8 @@ class Pikpak(ant.Ant):
                 "captcha_token": "",
             },
         )
-        data = res.json()
-        self.auth_pipeline.token = data
+        data = load_json(res)
+        self.auth_pipeline.set_token(data)
         return data
 
     async def list_files(self, parent_id: str = "") -> typing.Dict:
@@ -60,18 +103,27 @@ class Pikpak(ant.Ant):
         }
         if parent_id:
             params["parent_id"] = parent_id
-        res = await self.request(
-            "https://api-drive.mypikpak.com/drive/v1/files",
-            params=params,
-        )
-        return res.json()
+        files: typing.List[typing.Dict] = []
+        while True:
+            data = load_json(
+                await self.request(
+                    "https://api-drive.mypikpak.com/drive/v1/files",
+                    params=params,
+                )
+            )
+            files.extend(data.get("files", []))
+            if not data.get("next_page_token"):
+                break
+            params["page_token"] = data["next_page_token"]
+        data["files"] = files
+        return data
 
     async def get_file_link(self, file_id: str) -> typing.Dict:
-        return (
+        return load_json(
             await self.request(
                 f"https://api-drive.mypikpak.com/drive/v1/files/{file_id}",
             )
-        ).json()
+        )
 
     async def delete_file(
         self, file_ids: typing.List[str], trash: bool = True
@@ -80,43 +132,152 @@ class Pikpak(ant.Ant):
         if trash:
             url = "https://api-drive.mypikpak.com/drive/v1/files:batchTrash"
 
-        return (await self.request(url, method="post", json={"ids": file_ids})).json()
+        return load_json(await self.request(url, method="post", json={"ids": file_ids}))
 
     async def download(
-        self, url: str, path: str, start_at: int = 0, cache_size=10 * 1024 * 1024
+        self,
+        url: str,
+        path: str,
+        start_at: int = 0,
+        parts: int = 1,
+        size: int = 0,
     ):
         if os.path.exists(path):
             return
 
-        path += ".part"
-        if os.path.exists(path):
-            start_at = os.stat(path).st_size
+        part_path = path + ".part"
+        state_path = part_path + ".json"
+        with contextlib.suppress(FileNotFoundError):
+            start_at = os.stat(part_path).st_size
+
+        # an unfinished multi-part download is resumed whatever "parts" is now
+        if os.path.exists(state_path) or (parts > 1 and not start_at):
+            if not size:
+                size = await self.get_range_size(url)
+            if size:
+                try:
+                    await self.download_parts(url, part_path, size, parts)
+                    os.replace(part_path, path)
+                    return
+                except RangeNotSupported:
+                    pass
+            # start over with a single stream
+            for p in (part_path, state_path):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(p)
+            start_at = 0
 
+        loop = asyncio.get_event_loop()
         headers = {}
         if start_at:
             headers = {"Range": f"bytes={start_at}-"}
-        res = await self.request(url, stream=True, headers=headers)
-        downloaded = 0
-        with tqdm(
-            initial=start_at,
-            total=int(res.headers["Content-Length"]),
-            unit_scale=True,
-            unit_divisor=1024,
-            unit="B",
-            ascii=" \\/>",
+        async with self.download_client.stream("GET", url, headers=headers) as res:
+            res.raise_for_status()
+            if res.status_code != 206:
+                # range ignored, the whole file is coming
+                start_at = 0
+            with progress_bar(
+                initial=start_at,
+                total=start_at + int(res.headers.get("Content-Length", 0)),
+            ) as progress:
+                with open(part_path, "ab" if start_at else "wb") as f:
+                    async for bs in res.aiter_bytes(1024 * 1024):
+                        await loop.run_in_executor(self.io_executor, f.write, bs)
+                        progress.update(len(bs))
+        if size and os.path.getsize(part_path) != size:
+            raise httpx.HTTPError(f"Incomplete download of {path}")
+        os.replace(part_path, path)
+
+    async def get_range_size(self, url: str) -> int:
+        """Size of the file behind "url", 0 if it can't be fetched by ranges"""
+        res = await self.download_client.head(url)
+        if res.status_code != 200 or res.headers.get("Accept-Ranges") != "bytes":
+            return 0
+        return int(res.headers.get("Content-Length", 0))
+
+    async def download_parts(
+        self,
+        url: str,
+        path: str,
+        size: int,
+        parts: int,
+        part_size: int = 10 * 1024 * 1024,
+    ):
+        """Download byte ranges concurrently, finished ranges are recorded in a
+        ".json" file next to "path" so the download can be resumed"""
+        state_path = path + ".json"
+        done: typing.Set[int] = set()
+        if os.path.exists(state_path) and os.path.exists(path):
+            with open(state_path, "rb") as f:
+                done = set(json_loads(f.read()))
+        else:
+            with open(path, "wb") as f:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(f.fileno(), 0, size)
+                else:
+                    f.truncate(size)
+            with open(state_path, "wb") as f:
+                f.write(json_dumps([]))
+
+        loop = asyncio.get_event_loop()
+        ranges = list(parts_generator(size, part_size=part_size))
+        semaphore = asyncio.Semaphore(parts)
+        with progress_bar(
+            initial=sum(end - start + 1 for start, end in ranges if start in done),
+            total=size,
         ) as progress:
-            async with aiofiles.open(path, "ab" if start_at else "wb") as f:
-                cache_bs = b""
-                async for bs in res.aiter_bytes(5 * 1024 * 1024):
-                    cache_bs += bs
-                    if len(cache_bs) >= cache_size:
-                        await f.write(cache_bs)
-                        cache_bs = b""
-                    progress.update(res.num_bytes_downloaded - downloaded)
-                    downloaded = res.num_bytes_downloaded
-                if cache_bs:
-                    await f.write(cache_bs)
-        os.rename(path, path[:-5])
+
+            async def download_part(start: int, end: int):
+                async with semaphore:
+                    # a server may answer with a shorter range, ask for the rest
+                    pos = start
+                    while pos <= end:
+                        offset = pos
+                        async with self.download_client.stream(
+                            "GET", url, headers={"Range": f"bytes={pos}-{end}"}
+                        ) as res:
+                            res.raise_for_status()
+                            content_range = res.headers.get(
+                                "Content-Range", f"bytes {pos}-"
+                            )
+                            if res.status_code != 206 or not content_range.startswith(
+                                f"bytes {pos}-"
+                            ):
+                                raise RangeNotSupported(
+                                    f"Range request got {res.status_code} {content_range}"
+                                )
+                            with open(path, "r+b") as f:
+                                f.seek(pos)
+                                async for bs in res.aiter_bytes(1024 * 1024):
+                                    bs = bs[: end + 1 - pos]
+                                    if not bs:
+                                        break
+                                    await loop.run_in_executor(
+                                        self.io_executor, f.write, bs
+                                    )
+                                    pos += len(bs)
+                                    progress.update(len(bs))
+                        if pos == offset:
+                            raise httpx.HTTPError(f"Range {pos}-{end} got no data")
+                    done.add(start)
+                    with open(state_path, "wb") as f:
+                        f.write(json_dumps(sorted(done)))
+
+            await gather(
+                *(
+                    download_part(start, end)
+                    for start, end in ranges
+                    if start not in done
+                )
+            )
+        if len(done) != len(ranges) or os.path.getsize(path) != size:
+            raise httpx.HTTPError(f"Incomplete download of {path}")
+        os.remove(state_path)
+
+    async def close(self):
+        await super().close()
+        await self.download_client.aclose()
+        self.io_executor.shutdown()
 
     async def run(self):
         await self.login()
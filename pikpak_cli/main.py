@@ -1,35 +1,101 @@
 import argparse
 import asyncio
 import base64
+import bisect
 import contextlib
 import dataclasses
 import fnmatch
+import functools
 import getpass
 import inspect
 import json
 import os
+import re
+import shlex
 import sys
+import time
 import typing
 
-import IPython
 import prompt_toolkit
 import prompt_toolkit.auto_suggest
-import prompt_toolkit.buffer
 import prompt_toolkit.completion
 import prompt_toolkit.document
 import prompt_toolkit.history
-import tenacity
-from httpx import HTTPError
+from httpx import HTTPError, HTTPStatusError
 from rich import print, tree
 from rich.text import Text
 
 from pikpak_cli.ant import Pikpak
+from pikpak_cli.utils import AdaptiveLimiter, gather, json_dumps, json_loads
 
 
 class CliException(Exception):
     pass
 
 
+def is_overloaded(e: BaseException) -> bool:
+    # only statuses asking to slow down, a broken file mustn't slow the others
+    return isinstance(e, HTTPStatusError) and e.response.status_code in (429, 503)
+
+
+NEGATIVE_NUMBER = re.compile(r"-\d+$|-\d*\.\d+$")
+
+
+def is_option(arg: str) -> bool:
+    """Whether argparse would take "arg" for an option rather than a value"""
+    return (
+        arg.startswith("-")
+        and arg != "-"
+        and " " not in arg
+        and not NEGATIVE_NUMBER.match(arg)
+    )
+
+
+def is_retryable(e: BaseException) -> bool:
+    if isinstance(e, HTTPStatusError):
+        # other client errors like a deleted file won't go away by retrying
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (HTTPError, asyncio.TimeoutError))
+
+
+def split_line(line: str, posix: bool = False) -> typing.List[str]:
+    """Split on spaces. Quotes at the start and the end of a group of words keep
+    them together, quotes included, "posix" splits like a shell instead"""
+    if posix and ('"' in line or "'" in line):
+        # an unbalanced quote is most likely part of a name, like "Bob's"
+        with contextlib.suppress(ValueError):
+            return shlex.split(line)
+    tokens: typing.List[str] = []
+    group: typing.List[str] = []
+    for word in line.split(" "):
+        if group:
+            group.append(word)
+            if word.endswith(group[0][0]):
+                tokens.append(" ".join(group))
+                group = []
+        elif word[:1] in ("'", '"') and not (len(word) > 1 and word[-1] == word[0]):
+            group.append(word)
+        else:
+            tokens.append(word)
+    return tokens + group
+
+
+def unquote(word: str) -> str:
+    if len(word) > 1 and word[0] == word[-1] and word[0] in ("'", '"'):
+        return word[1:-1]
+    return word
+
+
+@functools.lru_cache(maxsize=None)
+def compile_patterns(patterns: str) -> typing.Optional[typing.Pattern]:
+    """Join comma separated shell patterns into one regex"""
+    if not patterns:
+        return None
+    return re.compile(
+        "|".join(f"(?:{fnmatch.translate(p)})" for p in patterns.split(","))
+    )
+
+
 @dataclasses.dataclass
 class Session:
     name: str = ".pikpak.session"
@@ -37,59 +103,130 @@ class Session:
     token: typing.Dict = dataclasses.field(default_factory=dict)
     account: str = ""
     password: str = ""
+    dirty: bool = dataclasses.field(
+        default=False, init=False, repr=False, compare=False
+    )
 
     def load(self):
-        with open(self.name, "r") as f:
-            for k, v in json.load(f).items():
-                setattr(self, k, v)
+        with open(self.name, "rb") as f:
+            data = json_loads(f.read())
+        for field in dataclasses.fields(self):
+            if field.init and field.name in data:
+                setattr(self, field.name, data[field.name])
         self.password = base64.b64decode(self.password).decode()
 
+    def update(self, **kwargs):
+        for k, v in kwargs.items():
+            if getattr(self, k) != v:
+                setattr(self, k, v)
+                self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {
+            "name": self.name,
+            "download_dir": self.download_dir,
+            "token": self.token,
+            "account": self.account,
+            "password": base64.b64encode(self.password.encode()).decode(),
+        }
+        # write aside and swap, an interrupted save can't corrupt the session
+        with open(self.name + ".tmp", "wb") as f:
+            f.write(json_dumps(data))
+        os.replace(self.name + ".tmp", self.name)
+        self.dirty = False
+
+
+@dataclasses.dataclass
+class ListingCache:
+    name: str = ".pikpak.cache"
+    ttl: float = 60 * 60
+    # folder ids are per account, the root one is "" for everyone
+    account: str = ""
+    listings: typing.Dict[str, typing.Dict] = dataclasses.field(default_factory=dict)
+    dirty: bool = dataclasses.field(
+        default=False, init=False, repr=False, compare=False
+    )
+
+    def load(self):
+        with open(self.name, "rb") as f:
+            data = json_loads(f.read())
+        self.account = data.get("account", "")
+        self.listings = data.get("listings", {})
+        self.prune()
+
     def save(self):
-        with open(self.name, "w") as f:
-            data = dataclasses.asdict(self)
-            data["password"] = base64.b64encode(self.password.encode()).decode()
-            json.dump(data, f)
+        if not self.dirty:
+            return
+        self.prune()
+        with open(self.name + ".tmp", "wb") as f:
+            f.write(json_dumps({"account": self.account, "listings": self.listings}))
+        os.replace(self.name + ".tmp", self.name)
+        self.dirty = False
+
+    def prune(self):
+        """Drop expired listings"""
+        now = time.time()
+        self.listings = {
+            k: v for k, v in self.listings.items() if now - v["ts"] < self.ttl
+        }
+
+    def clear(self, account: str):
+        self.account = account
+        self.listings = {}
+        self.dirty = True
+
+    def get(self, id: str) -> typing.Optional[typing.List[typing.Dict]]:
+        entry = self.listings.get(id)
+        if entry and time.time() - entry["ts"] < self.ttl:
+            return entry["files"]
+        return None
+
+    def set(self, id: str, files: typing.List[typing.Dict]):
+        self.listings[id] = {"ts": time.time(), "files": files}
+        self.dirty = True
+
+    def drop(self, id: str, recursion: bool = True):
+        """Drop a listing, and those of the folders below it"""
+        ids = [id]
+        while ids:
+            entry = self.listings.pop(ids.pop(), None)
+            if entry:
+                self.dirty = True
+                if recursion:
+                    ids.extend(f["id"] for f in entry["files"] if "folder" in f["kind"])
 
 
 @dataclasses.dataclass
 class File:
     source_data: typing.Dict[str, str]
     childrens: typing.Dict[str, "File"] = dataclasses.field(default_factory=dict)
+    childrens_by_id: typing.Dict[str, "File"] = dataclasses.field(default_factory=dict)
     father: typing.Optional["File"] = None
 
+    SIZE_UNITS = ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi", "Yi")
+
     @staticmethod
     def size2str(num: float, suffix="B") -> str:
-        for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
-            if abs(num) < 1024:
-                return f"{num:3.1f}{unit}{suffix}"
-            num /= 1024
-        return f"{num:.1f}Yi{suffix}"
+        # every 10 bits is a factor of 1024
+        i = min(max(int(abs(num)).bit_length() - 1, 0) // 10, len(File.SIZE_UNITS) - 1)
+        return f"{num / (1 << (10 * i)):3.1f}{File.SIZE_UNITS[i]}{suffix}"
+
+    SIZE_MULTIPLES = {
+        n: pow(1024, i)
+        for i, n in enumerate(["", "K", "M", "G", "T", "P", "E", "Z", "Y"])
+    }
+    SIZE_PATTERN = re.compile(r"\s*(\d+)\s*([KMGTPEZY]?)(?:i?B)?\s*", re.IGNORECASE)
 
     @staticmethod
     def size2int(size: str) -> int:
-        multiples = {}
-        for i, n in enumerate(["", "K", "M", "G", "T", "P", "E", "Z", "Y"]):
-            multiples[n] = pow(1024, i)
-
-        for n in list(multiples.keys()):
-            multiples[n + "B"] = multiples[n]
-            multiples[n + "iB"] = multiples[n]
-        for n in list(multiples.keys()):
-            multiples[n.lower()] = multiples[n]
-
-        multiple = 1
-        size_num = size
-        for n in multiples.keys():
-            if n and size.endswith(n):
-                multiple = multiples[n]
-                size_num = size.replace(n, "")
-                break
-
-        try:
-            return int(size_num) * multiple
-        except ValueError:
+        match = File.SIZE_PATTERN.fullmatch(size)
+        if not match:
             raise CliException(f"Wrong size: {size}")
 
+        return int(match.group(1)) * File.SIZE_MULTIPLES[match.group(2).upper()]
+
     @property
     def name(self) -> str:
         return self.source_data.get("name", "")
@@ -106,40 +243,51 @@ class File:
     def id(self) -> str:
         return self.source_data.get("id", "")
 
-    @property
+    @functools.cached_property
     def path(self) -> str:
         return f"{self.father.path}/{self.name}" if self.father else self.name
 
-    @property
+    @functools.cached_property
     def dirs(self) -> typing.List[str]:
         return self.father.dirs + [self.father.name] if self.father else []
 
-    @property
+    @functools.cached_property
     def description(self) -> Text:
-        return (
-            Text(self.source_data.get("modified_time", ""), style="gray")
-            + " "
-            + Text(self.human_size, style="blue")
-            + " "
-            + Text(self.name, style="green")
-            + ("/" if self.is_floder else "")
+        return Text.assemble(
+            self.source_data.get("modified_time", ""),
+            " ",
+            (self.human_size, "blue"),
+            " ",
+            (self.name, "green"),
+            "/" if self.is_floder else "",
+            style="gray",
         )
 
-    @property
+    @functools.cached_property
     def is_floder(self) -> bool:
         return "folder" in self.source_data.get("kind", "")
 
 
+def cli_spec(call: typing.Callable) -> typing.Tuple[inspect.Parameter, ...]:
+    """Command line parameters of "call", cached on the underlying function"""
+    func = getattr(call, "__func__", call)
+    if "__cli_spec__" not in func.__dict__:
+        func.__cli_spec__ = tuple(
+            v
+            for n, v in inspect.signature(call).parameters.items()
+            if not n.startswith("_")
+        )
+    return func.__cli_spec__
+
+
 @dataclasses.dataclass
 class Command:
     call: typing.Callable
     name: str = ""
-    parser: argparse.ArgumentParser = dataclasses.field(
-        default_factory=argparse.ArgumentParser
-    )
+    list_args: typing.Set[str] = dataclasses.field(default_factory=set)
 
-    @property
-    def help_text(self):
+    @functools.cached_property
+    def help_text(self) -> Text:
         return (
             Text(self.name, style="gray")
             + "\n"
@@ -148,26 +296,104 @@ class Command:
             + Text(self.parser.format_usage(), style="green")
         )
 
-    def _error(self, message: str):
-        raise CliException(message)
-
-    def __post_init__(self):
-        self.name = self.call.__name__
-        self.parser.prog = self.name
-        self.parser.description = self.call.__doc__ or ""
-        self.parser.error = self._error
-        for n, v in inspect.signature(self.call).parameters.items():
-            if n.startswith("_"):
-                continue
+    @functools.cached_property
+    def parser(self) -> argparse.ArgumentParser:
+        # only renders the help, command lines are parsed by "parse_args"
+        parser = argparse.ArgumentParser(
+            prog=self.name, description=self.call.__doc__ or ""
+        )
+        for v in cli_spec(self.call):
+            n = v.name
             if not v.default is inspect.Signature.empty:
                 if isinstance(v.default, bool):
-                    self.parser.add_argument(
+                    parser.add_argument(
                         f"--{n}", default=v.default, action="store_true"
                     )
                 else:
-                    self.parser.add_argument(f"--{n}", default=v.default)
+                    parser.add_argument(
+                        f"--{n}", default=v.default, type=type(v.default)
+                    )
+            else:
+                parser.add_argument(n, nargs="+")
+        return parser
+
+    def parse_args(self, args: typing.List[str]) -> typing.Dict:
+        """Parse "name [name ...] [--option value] [--flag]" like argparse does
+        with the parser above, but in one pass"""
+        params = {v.name: v for v in cli_spec(self.call)}
+        data: typing.Dict[str, typing.Any] = {
+            n: v.default
+            for n, v in params.items()
+            if v.default is not inspect.Signature.empty
+        }
+        positionals = []
+        closed = False
+        _args = iter(args)
+        for arg in _args:
+            if arg == "--":
+                # the rest are positionals
+                positionals.extend(_args)
+                break
+            if not is_option(arg):
+                if positionals and closed:
+                    # names are taken in one run, like argparse does
+                    raise CliException(f"unrecognized arguments: {arg}")
+                positionals.append(arg)
+                continue
+            closed = bool(positionals)
+            if not arg.startswith("--"):
+                raise CliException(f"unrecognized arguments: {arg}")
+            key, has_value, value = arg[2:].partition("=")
+            names = [key] if key in data else [n for n in data if n.startswith(key)]
+            if len(names) != 1:
+                raise CliException(
+                    f"ambiguous option: {arg}"
+                    if names
+                    else f"unrecognized arguments: {arg}"
+                )
+            n = names[0]
+            if isinstance(data[n], bool):
+                if has_value:
+                    raise CliException(
+                        f"argument --{n}: ignored explicit argument '{value}'"
+                    )
+                data[n] = True
+                continue
+            if not has_value:
+                value = next(_args, None)
+                if value is None or is_option(value):
+                    raise CliException(f"argument --{n}: expected one argument")
+            _type = type(params[n].default)
+            try:
+                data[n] = _type(unquote(value))
+            except ValueError:
+                raise CliException(
+                    f"argument --{n}: invalid {_type.__name__} value: '{value}'"
+                )
+
+        names = [n for n in params if n not in data]
+        if names and not positionals:
+            raise CliException(
+                f"the following arguments are required: {', '.join(names)}"
+            )
+        elif names:
+            n = names[0]
+            if n in self.list_args:
+                data[n] = positionals
+            elif len(positionals) == 1:
+                data[n] = unquote(positionals[0])
             else:
-                self.parser.add_argument(n, nargs="+")
+                data[n] = " ".join(positionals)
+        elif positionals:
+            raise CliException(f"unrecognized arguments: {' '.join(positionals)}")
+        return data
+
+    def __post_init__(self):
+        self.name = self.call.__name__
+        for v in cli_spec(self.call):
+            if v.default is inspect.Signature.empty:
+                if v.annotation == typing.List[str]:
+                    self.list_args.add(v.name)
 
 
 class Commander:
@@ -175,11 +401,24 @@ class Commander:
         self.session = Session()
         with contextlib.suppress(FileNotFoundError, json.JSONDecodeError):
             self.session.load()
+        self.listing_cache = ListingCache()
+        with contextlib.suppress(FileNotFoundError, json.JSONDecodeError):
+            self.listing_cache.load()
+        if self.listing_cache.account != self.session.account:
+            self.listing_cache.clear(self.session.account)
         self.ant = Pikpak()
-        self.ant.auth_pipeline.token = self.session.token
+        self.ant.auth_pipeline.set_token(self.session.token)
         self.root_file = File({"kind": "folder", "name": "", "id": ""})
         self.current_file = self.root_file
         self.CMDS: typing.Dict[str, Command] = {}
+        self.list_semaphore = asyncio.Semaphore(16)
+        self.listings: typing.Dict[typing.Tuple[str, bool], asyncio.Future] = {}
+        # folders listed by this process, others may come from the disk cache
+        self.fresh_ids: typing.Set[str] = set()
+        # resolved lookups by absolute path, cleared whenever the tree changes
+        self.path_cache: typing.Dict[str, File] = {}
+        # shared by all downloads, so they back off together
+        self.download_limiter = AdaptiveLimiter(overloaded=is_overloaded)
         asyncio.ensure_future(self.refresh_token())
 
         for f in (
@@ -199,15 +438,45 @@ class Commander:
             cmd = Command(f)
             self.CMDS[cmd.name] = cmd
 
-    async def fetch_file_childen(self, file: File) -> typing.Dict[str, File]:
-        if not file.childrens:
-            file.childrens = {
-                f["name"]: File(f, father=file)
-                for f in (await self.ant.list_files(parent_id=file.id))["files"]
-            }
+    async def _list_files(
+        self, file: File, fresh: bool = False
+    ) -> typing.List[typing.Dict]:
+        files = None if fresh else self.listing_cache.get(file.id)
+        if files is None:
+            async with self.list_semaphore:
+                files = (await self.ant.list_files(parent_id=file.id))["files"]
+            self.listing_cache.set(file.id, files)
+            self.fresh_ids.add(file.id)
+        return files
+
+    async def fetch_file_childen(
+        self, file: File, fresh: bool = False
+    ) -> typing.Dict[str, File]:
+        """Children of a folder, "fresh" ones are not taken from the disk cache"""
+        if file.childrens and (not fresh or file.id in self.fresh_ids):
+            return file.childrens
+
+        # concurrent lookups of the same folder share one request
+        key = (file.id, fresh)
+        if key not in self.listings:
+            self.listings[key] = asyncio.ensure_future(self._list_files(file, fresh))
+            self.listings[key].add_done_callback(lambda _: self.listings.pop(key, None))
+        files = await asyncio.shield(self.listings[key])
+        # keep the known files, and with them their own listings
+        old = file.childrens_by_id
+        file.childrens_by_id = {
+            f["id"]: old.get(f["id"]) or File(f, father=file) for f in files
+        }
+        file.childrens = {f.name: f for f in file.childrens_by_id.values()}
+        if old.keys() - file.childrens_by_id.keys():
+            self.path_cache.clear()
         return file.childrens
 
-    async def find_file(self, file: File, name: str) -> File:
+    async def find_file(self, file: File, name: str, fresh: bool = False) -> File:
+        key = f"{file.path}/{name}"
+        if not fresh and key in self.path_cache:
+            return self.path_cache[key]
+
         for n in name.split("/"):
             if n == "/":
                 file = self.root_file
@@ -215,27 +484,37 @@ class Commander:
                 continue
             elif n == "..":
                 file = file.father if file.father else file
-            elif n not in await self.fetch_file_childen(file):
+            elif n not in await self.fetch_file_childen(file, fresh):
                 raise CliException(f"{name} not found")
             else:
                 file = file.childrens[n]
 
+        self.path_cache[key] = file
         return file
 
+    async def find_files(
+        self, file: File, names: typing.List[str], fresh: bool = False
+    ) -> typing.List[File]:
+        return await gather(*(self.find_file(file, n, fresh) for n in names))
+
     async def traverse_files(
-        self, file: File, recursion: bool = True
+        self, file: File, recursion: bool = True, fresh: bool = False
     ) -> typing.AsyncGenerator[File, None]:
         if not file.is_floder:
             yield file
             return
 
-        for f in sorted(
-            (await self.fetch_file_childen(file)).values(), key=lambda f: f.name
-        ):
-            yield f
-            if f.is_floder and recursion:
-                async for _f in self.traverse_files(f):
-                    yield _f
+        # breadth first, all folders of one level are listed concurrently
+        folders = [file]
+        while folders:
+            await gather(*(self.fetch_file_childen(f, fresh) for f in folders))
+            childrens = [f.childrens_by_id for f in folders]
+            folders = []
+            for c in childrens:
+                for f in sorted(c.values(), key=lambda f: f.name):
+                    yield f
+                    if f.is_floder and recursion:
+                        folders.append(f)
 
     def parse(self, input) -> typing.Tuple[typing.Optional[Command], typing.Dict]:
         cmd = None
@@ -253,15 +532,7 @@ class Commander:
 
         if input.endswith("-h") or input.endswith("?"):
             return cmd, {"help": True}
-        else:
-            ns = cmd.parser.parse_args(args=input.split(" ")[1:])
-            data = {}
-            for k, v in ns.__dict__.items():
-                if isinstance(v, list):
-                    data[k] = " ".join(v)
-                else:
-                    data[k] = v
-        return cmd, data
+        return cmd, cmd.parse_args(split_line(input, posix=bool(cmd.list_args))[1:])
 
     def exec(self, input: str):
         task: typing.Optional[asyncio.Future] = None
@@ -279,7 +550,7 @@ class Commander:
 
             res = cmd.call(**args)
             if asyncio.iscoroutine(res):
-                task = asyncio.gather(res)
+                task = asyncio.get_event_loop().create_task(res)
                 asyncio.get_event_loop().run_until_complete(task)
         except CliException as e:
             print("input error:", Text(str(e), style="red"))
@@ -290,8 +561,12 @@ class Commander:
                     asyncio.get_event_loop().run_until_complete(task)
         except HTTPError as e:
             print("http error:", Text(str(e), style="red"))
+        finally:
+            self.listing_cache.save()
 
     def shell(self):
+        import IPython
+
         IPython.embed(header=f"Shell:\n", using="asyncio", colors="Neutral")
 
     def info(self):
@@ -308,7 +583,8 @@ class Commander:
     def config(self, downlaod_dir: str = ""):
         """Set default download dir or"""
         os.makedirs(downlaod_dir, exist_ok=True)
-        self.session.download_dir = downlaod_dir
+        self.session.update(download_dir=downlaod_dir)
+        self.session.save()
 
     async def login(self, account: str, password: str = "", _echo: bool = True):
         """Login account"""
@@ -316,17 +592,24 @@ class Commander:
             password = getpass.getpass("Input your password:")
 
         token = await self.ant.login(account, password)
-        self.session.account = account
-        self.session.password = password
-        self.session.token = token
-        self.session.save()
+        if account != self.session.account:
+            # nothing listed for the old account is valid any more
+            self.listing_cache.clear(account)
+            self.root_file.childrens = {}
+            self.root_file.childrens_by_id = {}
+            self.path_cache.clear()
+            self.fresh_ids.clear()
+            self.current_file = self.root_file
+        self.session.update(account=account, password=password, token=token)
+        # keep file io off the loop, downloads may be running
+        await asyncio.get_event_loop().run_in_executor(None, self.session.save)
         if _echo:
             print(Text(f"Hello {account}!", style="blue"))
 
     async def refresh_token(self):
         while True:
             await asyncio.sleep(10 * 60)
-            with contextlib.suppress():
+            with contextlib.suppress(HTTPError):
                 if self.session.account and self.session.password:
                     await self.login(
                         self.session.account,
@@ -340,9 +623,16 @@ class Commander:
         without_audit: bool = False,
         trash: bool = False,
         recursion: bool = False,
+        refresh: bool = False,
     ):
         """List current dir files"""
         file = await self.find_file(self.current_file, name)
+        if refresh:
+            # drop the cached listing, sub folders are rebuilt along with it
+            file.childrens = {}
+            file.childrens_by_id = {}
+            self.path_cache.clear()
+            self.listing_cache.drop(file.id)
         root_tree = tree.Tree(file.description)
         if not file.is_floder:
             print(file.description)
@@ -366,7 +656,7 @@ class Commander:
 
     async def cd(self, name: str):
         """Change directory"""
-        file = await self.find_file(self.current_file, name)
+        file = await self.find_file(self.current_file, name, fresh=True)
         if not file.is_floder:
             raise CliException(f"{name} is not a floder")
 
@@ -378,20 +668,41 @@ class Commander:
 
         size = 0
         async for f in self.traverse_files(file):
-            size += f.size
+            if not f.is_floder:
+                size += f.size
 
         print(Text("all size: ", "green"), Text(File.size2str(size), "blue"))
 
-    async def rm(self, name: str, no_trash: bool = False):
-        file = await self.find_file(self.current_file, name)
+    async def rm(self, name: typing.List[str], no_trash: bool = False):
+        files = await self.find_files(self.current_file, name, fresh=True)
 
-        await self.ant.delete_file([file.id], trash=not no_trash)
-        if file.father:
-            file.father.childrens.pop(file.name)
+        await self.ant.delete_file([f.id for f in files], trash=not no_trash)
+        for f in files:
+            if f.father:
+                f.father.childrens.pop(f.name, None)
+                f.father.childrens_by_id.pop(f.id, None)
+                self.listing_cache.drop(f.father.id, recursion=False)
+            self.listing_cache.drop(f.id)
+        self.path_cache.clear()
 
-    async def _download(self, f: File, path: str):
+    async def _get_download_url(self, f: File) -> str:
         data = await self.ant.get_file_link(f.id)
-        await self.ant.download(data["links"]["application/octet-stream"]["url"], path)
+        return data["links"]["application/octet-stream"]["url"]
+
+    async def _download(
+        self,
+        f: File,
+        path: str,
+        parts: int = 1,
+        urls: typing.Optional[typing.Dict[str, str]] = None,
+    ):
+        async with self.download_limiter:
+            print(Text(f"Downloading {f.name} to {path}...", style="green"))
+            # a prefetched url is only used once, retries fetch a fresh one
+            url = urls.pop(f.id, "") if urls else ""
+            if not url:
+                url = await self._get_download_url(f)
+            await self.ant.download(url, path, parts=parts, size=f.size)
 
     async def download(
         self,
@@ -402,44 +713,46 @@ class Commander:
         size: str = "",
         relative_path: bool = False,
         new_file_name: str = "",
+        concurrency: int = 8,
+        parts: int = 1,
     ):
         """Download a file or many files in a directory"""
-        file = await self.find_file(self.current_file, name)
-        async for f in self.traverse_files(file):
+        import tenacity
+
+        if concurrency < 1:
+            raise CliException(f"Wrong concurrency: {concurrency}")
+        if parts < 1:
+            raise CliException(f"Wrong parts: {parts}")
+        file = await self.find_file(self.current_file, name, fresh=True)
+        include_pattern = compile_patterns(includes)
+        exclude_pattern = compile_patterns(excludes)
+        min_size = File.size2int(size) if size else 0
+        files: typing.List[typing.Tuple[File, str]] = []
+        planned: typing.Set[str] = set()
+        made_dirs: typing.Set[str] = set()
+        async for f in self.traverse_files(file, fresh=True):
             if f.is_floder:
                 continue
             if f.source_data.get("trashed"):
                 continue
             # filter
-            if includes:
-                include = False
-                for p in includes.split(","):
-                    if fnmatch.fnmatch(f.name, p):
-                        include = True
-                        break
-                if not include:
-                    print(
-                        Text(
-                            f"{f.name} ignored by include pattern {includes}",
-                            style="green",
-                        )
+            if include_pattern and not include_pattern.match(f.name):
+                print(
+                    Text(
+                        f"{f.name} ignored by include pattern {includes}",
+                        style="green",
                     )
-                    continue
-            if excludes:
-                exclude = False
-                for p in excludes.split(","):
-                    if fnmatch.fnmatch(f.name, p):
-                        exclude = True
-                        break
-                if exclude:
-                    print(
-                        Text(
-                            f"{f.name} ignored by exclude pattern {excludes} matched",
-                            style="green",
-                        )
+                )
+                continue
+            if exclude_pattern and exclude_pattern.match(f.name):
+                print(
+                    Text(
+                        f"{f.name} ignored by exclude pattern {excludes} matched",
+                        style="green",
                     )
-                    continue
-            if size and f.size < File.size2int(size):
+                )
+                continue
+            if f.size < min_size:
                 print(
                     Text(
                         f"{f.name}({f.human_size}) ignored by size limit",
@@ -459,27 +772,71 @@ class Commander:
                 filename = os.path.join(
                     dir, *f.dirs[len(self.current_file.dirs) + 1 :], _file_name
                 )
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            print(Text(f"Downloading {f.name} to {filename}...", style="green"))
+            # concurrent downloads to one path would write the same .part file
+            if filename in planned:
+                print(
+                    Text(
+                        f"{f.name} ignored, target {filename} already planned",
+                        style="green",
+                    )
+                )
+                continue
+            planned.add(filename)
+            if os.path.dirname(filename) not in made_dirs:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                made_dirs.add(os.path.dirname(filename))
+            files.append((f, filename))
+
+        # a file holds a slot from fetching its link to the end of its download,
+        # so links are fetched at most "concurrency" files ahead of their use
+        lookahead = asyncio.Semaphore(2 * concurrency)
+        # every download starts from the asked concurrency
+        self.download_limiter.max_limit = concurrency
+        self.download_limiter.limit = concurrency
+        self.download_limiter.successes = 0
+
+        retrying = tenacity.AsyncRetrying(
+            # downloads resume, so ride out long CDN hiccups
+            wait=tenacity.wait_exponential(multiplier=1, min=10, max=60),
+            stop=tenacity.stop_after_attempt(30),
+            retry=tenacity.retry_if_exception(is_retryable),
+            reraise=True,
+        )
+        urls: typing.Dict[str, str] = {}
+        failed: typing.List[str] = []
+
+        async def download_file(f: File, filename: str):
             if not os.path.exists(filename):
-                await tenacity.retry(
-                    wait=tenacity.wait.wait_incrementing(10, increment=20),
-                    stop=tenacity.stop_after_attempt(30),
-                    retry=tenacity.retry_if_exception_type(
-                        (HTTPError, asyncio.TimeoutError)
-                    ),
-                    reraise=True,
-                )(self._download)(f, filename)
+                async with lookahead:
+                    with contextlib.suppress(HTTPError):
+                        urls[f.id] = await self._get_download_url(f)
+                    # a retrying object holds the state of one run, copy it per file
+                    try:
+                        async for attempt in retrying.copy():
+                            with attempt:
+                                await self._download(f, filename, parts, urls)
+                    except (HTTPError, asyncio.TimeoutError) as e:
+                        # give up on this file only, the others keep going
+                        print(Text(f"Failed {filename}: {e}", style="red"))
+                        failed.append(filename)
+                        return
             print(Text(f"Downloaded {filename}", style="blue"))
 
+        await gather(*(download_file(f, filename) for f, filename in files))
+        if failed:
+            print(Text(f"{len(failed)} files failed to download", style="red"))
+
     def exit(self):
         """Exit cli"""
+        # close the pooled connections cleanly
+        asyncio.get_event_loop().run_until_complete(self.ant.close())
         sys.exit()
 
 
 class Competer(prompt_toolkit.completion.Completer):
     def __init__(self, commander: Commander) -> None:
         self.commander = commander
+        self.cmd_names = sorted(commander.CMDS)
 
     def get_completions(
         self, *args, **kwargs
@@ -491,55 +848,64 @@ class Competer(prompt_toolkit.completion.Completer):
         document: prompt_toolkit.document.Document,
         complete_event: prompt_toolkit.completion.CompleteEvent,
     ) -> typing.AsyncGenerator[prompt_toolkit.completion.Completion, None]:
+        if not complete_event.completion_requested:
+            return
+
+        if " " not in document.text:
+            # still typing the command name, no need to parse
+            i = bisect.bisect_left(self.cmd_names, document.text)
+            while i < len(self.cmd_names) and self.cmd_names[i].startswith(
+                document.text
+            ):
+                yield prompt_toolkit.completion.Completion(
+                    self.cmd_names[i][len(document.text) :]
+                )
+                i += 1
+            return
+
         try:
             cmd, args = self.commander.parse(document.text)
         except CliException:
-            cmd = None
-            args = None
-        if not complete_event.completion_requested:
+            return
+        if not cmd or "name" not in args:
+            return
+        if cmd.name not in ("cd", "ls", "download", "du"):
             return
 
-        if not cmd or not args:
-            for n in self.commander.CMDS.keys():
-                if n.startswith(document.text):
-                    yield prompt_toolkit.completion.Completion(
-                        n.replace(document.text, "")
-                    )
-        else:
-            if cmd.name in ("cd", "ls", "download", "du"):
-                dir = "/".join(args["name"].split("/")[:-1]) or "."
-                file = args["name"].split("/")[-1]
-                f = await self.commander.find_file(self.commander.current_file, dir)
-                try:
-                    if file in (await self.commander.fetch_file_childen(f)).keys():
-                        next_f = await self.commander.find_file(f, file)
-                        for n in (
-                            await self.commander.fetch_file_childen(next_f)
-                        ).keys():
-                            yield prompt_toolkit.completion.Completion("/" + n)
-                    else:
-                        for n in (await self.commander.fetch_file_childen(f)).keys():
-                            if n.startswith(file):
-                                yield prompt_toolkit.completion.Completion(
-                                    n.replace(file, "")
-                                )
-                except CliException:
-                    pass
+        dir = "/".join(args["name"].split("/")[:-1]) or "."
+        file = args["name"].split("/")[-1]
+        f = await self.commander.find_file(self.commander.current_file, dir)
+        try:
+            if file in (await self.commander.fetch_file_childen(f)).keys():
+                next_f = await self.commander.find_file(f, file)
+                for n in (await self.commander.fetch_file_childen(next_f)).keys():
+                    yield prompt_toolkit.completion.Completion("/" + n)
+            else:
+                for n in (await self.commander.fetch_file_childen(f)).keys():
+                    if n.startswith(file):
+                        yield prompt_toolkit.completion.Completion(n.replace(file, ""))
+        except CliException:
+            pass
 
 
 def main():
+    # one loop for the prompt and the commands, so background tasks like the
+    # token refresh keep running while waiting for input
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     commander = Commander()
     commander.info()
     print(Text("try typing help", style="green"))
+    session: prompt_toolkit.PromptSession = prompt_toolkit.PromptSession(
+        "pikpak_cli>",
+        history=prompt_toolkit.history.FileHistory("history.txt"),
+        auto_suggest=prompt_toolkit.auto_suggest.AutoSuggestFromHistory(),
+        completer=Competer(commander),
+    )
 
     while True:
         try:
-            user_input = prompt_toolkit.prompt(
-                "pikpak_cli>",
-                history=prompt_toolkit.history.FileHistory("history.txt"),
-                auto_suggest=prompt_toolkit.auto_suggest.AutoSuggestFromHistory(),
-                completer=Competer(commander),
-            )
+            user_input = loop.run_until_complete(session.prompt_async())
             commander.exec(user_input)
         except KeyboardInterrupt:
             pass
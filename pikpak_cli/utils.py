@@ -0,0 +1,68 @@
+import asyncio
+import json
+import typing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(obj: typing.Any) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def json_loads(data: typing.Union[bytes, str]) -> typing.Any:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+async def gather(*aws: typing.Awaitable) -> typing.List:
+    """Like "asyncio.gather", but cancel the others once one of them failed"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AdaptiveLimiter:
+    """Concurrency limit adjusted like TCP congestion control (AIMD): grow by one
+    after "limit" successes, halve when a job fails with an overload error"""
+
+    def __init__(
+        self,
+        limit: int = 4,
+        max_limit: int = 8,
+        overloaded: typing.Callable[[BaseException], bool] = lambda e: True,
+    ):
+        self.limit = limit
+        self.max_limit = max_limit
+        self.overloaded = overloaded
+        self.running = 0
+        self.successes = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.running < self.limit)
+            self.running += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.running -= 1
+            if exc is None:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.limit + 1, self.max_limit)
+                    self.successes = 0
+            elif self.overloaded(exc):
+                self.limit = max(self.limit // 2, 1)
+                self.successes = 0
+            self._condition.notify_all()
@@ -10,12 +10,25 @@ HTTPX_CONFIG = {
     "max_redirects": 20,
     "limits": httpx.Limits(max_connections=100, max_keepalive_connections=100),
     "trust_env": True,
+    # multiplex the api requests over one connection
+    "http2": True,
     "proxies": None,
     "auth": None,
     "headers": None,
     "cookies": None,
 }
 
+# httpx config of the file download client, CDNs stream better over
+# HTTP/1.1 connections kept alive between files and parts
+DOWNLOAD_HTTPX_CONFIG = {
+    "timeout": 10.0,
+    "limits": httpx.Limits(
+        max_connections=100, max_keepalive_connections=32, keepalive_expiry=60
+    ),
+    "trust_env": True,
+    "http2": False,
+}
+
 POOL_CONFIG = {
     "limit": 100,
 }
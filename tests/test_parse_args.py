@@ -0,0 +1,105 @@
+import typing
+
+import pytest
+
+from pikpak_cli.main import CliException, Command
+
+
+def ls(
+    name: str,
+    without_audit: bool = False,
+    trash: bool = False,
+    recursion: bool = False,
+):
+    pass
+
+
+def rm(name: typing.List[str], no_trash: bool = False):
+    pass
+
+
+def download(
+    name: str,
+    dir: str = "",
+    size: str = "",
+    relative_path: bool = False,
+    new_file_name: str = "",
+    concurrency: int = 8,
+    parts: int = 1,
+):
+    pass
+
+
+def pwd():
+    pass
+
+
+def config(downlaod_dir: str = ""):
+    pass
+
+
+COMMANDS = {f.__name__: Command(f) for f in (ls, rm, download, pwd, config)}
+
+
+def argparse_args(cmd: Command, args: typing.List[str]) -> typing.Optional[dict]:
+    """What the argparse based parser used to return, None for an error"""
+    try:
+        ns = cmd.parser.parse_args(args)
+    except SystemExit:
+        return None
+    return {
+        k: " ".join(v) if isinstance(v, list) and k not in cmd.list_args else v
+        for k, v in vars(ns).items()
+    }
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        "pwd",
+        "pwd x",
+        "ls a",
+        "ls a b",
+        "ls  a",
+        "ls a --trash --rec",
+        "ls --trash a",
+        "ls",
+        "ls --trash",
+        "ls --re a",
+        "ls --recursion=1 a",
+        "ls -r a",
+        "ls -- --trash",
+        "ls a -- b",
+        "ls a --trash b",
+        "ls a -- b --trash",
+        "ls --",
+        "ls -",
+        "ls -5",
+        "ls --bogus a",
+        "rm a b --no_trash",
+        "rm a",
+        "rm a --no_trash b",
+        "download x --size 5M --concurrency 3 --parts=2",
+        "download x --concurrency a",
+        "download x --concurrency",
+        "download x --concurrency -1",
+        "download x --dir --trash",
+        "download x --dir -foo",
+        "download x --dir=-foo",
+        "download x --dir=",
+        "download x --relative_path --new_file_name y z",
+        "download x --c 2",
+        "config --downlaod_dir d",
+        "config",
+        "config d",
+    ],
+)
+def test_parse_args_like_argparse(line: str):
+    name, *args = line.split(" ")
+    cmd = COMMANDS[name]
+    expected = argparse_args(cmd, args)
+    if expected is None:
+        with pytest.raises(CliException):
+            cmd.parse_args(args)
+    else:
+        assert cmd.parse_args(args) == expected